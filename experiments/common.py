@@ -37,16 +37,67 @@ def assert_not_done(result_folder, result_subfolder, n_done=1, seed=None):
 
 
 def normalise_data(X, train_X):
-    # X is assumed to be of shape (..., length, channel)
-    out = []
-    for Xi, train_Xi in zip(X.unbind(dim=-1), train_X.unbind(dim=-1)):
-        mean = train_Xi.mean()
-        std = train_Xi.std()
-        out.append((Xi - mean) / (1e-5 + std))
-    return torch.stack(out, dim=-1)
-
-
-def dataloader(dataset, **kwargs):
+    # X is assumed to be of shape (..., length, channel). It is normalised in-place (and also returned), using
+    # per-channel statistics from the training data, so no intermediate copies are made.
+    train_X = train_X.reshape(-1, train_X.size(-1))
+    mean = train_X.mean(dim=0)
+    std = train_X.std(dim=0)
+    return X.sub_(mean).div_(1e-5 + std)
+
+
+class _BucketBatchSampler(torch.utils.data.Sampler):
+    """Yields batches of indices grouped by series length, so that each batch need only be padded to the length of
+    the longest series it actually contains, rather than the longest series in the whole dataset."""
+    def __init__(self, lengths, batch_size, shuffle, drop_last):
+        super(_BucketBatchSampler, self).__init__(None)
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        indices = np.arange(len(self.lengths))
+        if self.shuffle:
+            indices = np.random.permutation(indices)
+        # The stable sort preserves the fresh permutation between equal lengths, so batch composition (ties, and
+        # hence bucket boundaries) re-randomises every epoch rather than freezing on the first sort; for an
+        # equal-length dataset this is exactly a sample-level shuffle.
+        indices = indices[np.argsort(self.lengths[indices], kind='stable')]
+        remainder = len(indices) % self.batch_size
+        if self.drop_last and remainder != 0:
+            # Drop a randomly positioned run of the sorted order, rather than always the tail - which would
+            # permanently exclude the longest series from training.
+            if self.shuffle:
+                start = np.random.randint(len(indices) - remainder + 1)
+            else:
+                start = len(indices) - remainder
+            indices = np.concatenate([indices[:start], indices[start + remainder:]])
+        batches = [indices[i:i + self.batch_size].tolist() for i in range(0, len(indices), self.batch_size)]
+        if self.shuffle:
+            np.random.shuffle(batches)
+        for batch in batches:
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return int(math.ceil(len(self.lengths) / self.batch_size))
+
+
+def _trim_collate(min_length):
+    # Collates (X, y, length) triples into the usual (X, y) batches, trimming the padding of X down to the longest
+    # series actually present in the batch. min_length is a floor on the trimmed length, so that e.g. the batch is
+    # never too short for the maximum shapelet length.
+    def collate(batch):
+        X, y, lengths = torch.utils.data.dataloader.default_collate(batch)
+        length = int(lengths.max())
+        if min_length is not None:
+            length = max(length, min_length)
+        return X[:, :length], y
+    return collate
+
+
+def dataloader(dataset, lengths=None, min_length=None, **kwargs):
     if 'shuffle' not in kwargs:
         kwargs['shuffle'] = True
     if 'drop_last' not in kwargs:
@@ -54,6 +105,12 @@ def dataloader(dataset, **kwargs):
     if 'batch_size' not in kwargs:
         kwargs['batch_size'] = 32
     kwargs['batch_size'] = min(kwargs['batch_size'], len(dataset))
+    if lengths is not None:
+        # Bucket similar-length series together and trim each batch's padding, eliminating wasted shapelet compute
+        # on the padded tails. The dataset must yield (X, y, length) triples in this case.
+        kwargs['batch_sampler'] = _BucketBatchSampler(lengths, kwargs.pop('batch_size'), kwargs.pop('shuffle'),
+                                                      kwargs.pop('drop_last'))
+        kwargs['collate_fn'] = _trim_collate(min_length)
     return torch.utils.data.DataLoader(dataset, **kwargs)
 
 
@@ -165,6 +222,9 @@ class LinearShapeletTransform(torch.nn.Module):
         self.log = log
 
     def forward(self, times, X):
+        # X may have had its padding trimmed relative to the full time grid, if it came through a length-bucketed
+        # dataloader; times is a uniform grid so truncating it recovers the matching times.
+        times = times[:X.size(-2)]
         shapelet_similarity, closest_index = self.shapelet_transform(times, X)
         if self.log:
             log_shapelet_similarity = (shapelet_similarity + 1e-5).log()
@@ -323,11 +383,10 @@ class _TensorEncoder(json.JSONEncoder):
 
 def save_results(result_folder, result_subfolder, results):
     base_loc = here / 'results' / result_folder
-    if not os.path.exists(base_loc):
-        os.mkdir(base_loc)
+    # exist_ok as parallel sweep workers share the same base folder and may finish close together.
+    os.makedirs(base_loc, exist_ok=True)
     loc = base_loc / result_subfolder
-    if not os.path.exists(loc):
-        os.mkdir(loc)
+    os.makedirs(loc, exist_ok=True)
     num = -1
     for filename in os.listdir(loc):
         try:
@@ -460,10 +519,14 @@ def upsample_minimizers_and_shapelets(times,
         new_shapelet_times = torch.Tensor([x for x in new_shapelet_times if x not in shapelet_times])
         _, shapelet_interp = upsample_path(shapelet_times, shapelets[i], new_shapelet_times)
 
-        # Find the grid index that minimizes the absolute distance between the shapelet and the minimizer
+        # Find the grid index that minimizes the absolute distance between the shapelet and the minimizer.
+        # unfold gives a zero-copy strided view onto every candidate window; the windows are chunked so that the
+        # broadcast difference only ever materialises a bounded number of them at once.
         shapelet_len = shapelet_interp.size(0)
-        distances = [(minimizer_interp[j:j+shapelet_len, 0:10] - shapelet_interp[:, 0:10]).abs().mean().item() for j in range(n_grid - shapelet_len)]
-        argmin = np.argmin(distances)
+        windows = minimizer_interp[:, 0:10].unfold(0, shapelet_len, 1)[:n_grid - shapelet_len]
+        target = shapelet_interp[:, 0:10].t()
+        distances = torch.cat([(chunk - target).abs().mean(dim=(1, 2)) for chunk in windows.split(256)])
+        argmin = distances.argmin().item()
         new_shapelet_times = uniform_grid[argmin:argmin + shapelet_len]
 
         all_upsampled_minimizers.append(minimizer_interp)
@@ -1,4 +1,4 @@
-import collections as co
+import concurrent.futures
 import numpy as np
 import os
 import pathlib
@@ -12,13 +12,6 @@ import common
 here = pathlib.Path(__file__).resolve().parent
 
 
-def _pad(channel, maxlen):
-    channel = torch.tensor(channel)
-    out = torch.full((maxlen,), channel[-1])
-    out[:channel.size(0)] = channel
-    return out
-
-
 valid_dataset_names = ('ArticularyWordRecognition',
                        'FaceDetection',
                        'NATOPS',
@@ -113,9 +106,7 @@ l2_hyperparameter_output = (
 )
 
 
-def get_data(dataset_name, missing_rate, noise_channels):
-    assert dataset_name in valid_dataset_names, "Must specify a valid dataset name."
-
+def _load_and_preprocess_data(dataset_name, missing_rate, noise_channels):
     base_filename = here / 'data' / 'UEA' / 'Multivariate_ts' / dataset_name / dataset_name
     train_X, train_y = sktime.utils.load_data.load_from_tsfile_to_dataframe(str(base_filename) + '_TRAIN.ts')
     test_X, test_y = sktime.utils.load_data.load_from_tsfile_to_dataframe(str(base_filename) + '_TEST.ts')
@@ -125,11 +116,17 @@ def get_data(dataset_name, missing_rate, noise_channels):
     all_X = np.concatenate((train_X, test_X), axis=0)
     all_y = np.concatenate((train_y, test_y), axis=0)
 
-    lengths = torch.tensor([len(Xi[0]) for Xi in all_X])
-    maxlen = lengths.max()
-    # Each channel is a pandas.core.series.Series object of length corresponding to the length of the time series
-    all_X = torch.stack([torch.stack([_pad(channel, maxlen) for channel in batch], dim=0) for batch in all_X], dim=0)
-    all_X = all_X.transpose(-1, -2)
+    lengths = np.array([len(Xi[0]) for Xi in all_X])
+    maxlen = int(lengths.max())
+    # Each channel is a pandas.core.series.Series object of length corresponding to the length of the time series.
+    # Copy everything into one preallocated array, padding each channel out with its final value.
+    padded_X = np.empty((all_X.shape[0], all_X.shape[1], maxlen), dtype=np.float32)
+    for batch_index, Xi in enumerate(all_X):
+        for channel_index, channel in enumerate(Xi):
+            channel = np.asarray(channel, dtype=np.float32)
+            padded_X[batch_index, channel_index, :len(channel)] = channel
+            padded_X[batch_index, channel_index, len(channel):] = channel[-1]
+    all_X = torch.from_numpy(padded_X).transpose(-1, -2)
 
     if noise_channels != 0:
         generator = torch.Generator().manual_seed(45678)
@@ -141,73 +138,106 @@ def get_data(dataset_name, missing_rate, noise_channels):
     # Handle missingness: remove values and replace them with the linear interpolation of the non-missing points.
     if missing_rate > 0:
         generator = torch.Generator().manual_seed(56789)
-        for batch_index in range(all_X.size(0)):
-            for channel_index in range(all_X.size(2)):
-                randperm = torch.randperm(all_X.size(1) - 2, generator=generator) + 1  # keep the start and end
-                removed_points = randperm[:int(all_X.size(1) * missing_rate)].sort().values
-
-                prev_removed_point = removed_points[0]
-                prev_unremoved_point = prev_removed_point - 1
-                prev_unremoved_points = [prev_unremoved_point]
-                for removed_point in removed_points[1:]:
-                    if prev_removed_point != removed_point - 1:
-                        prev_unremoved_point = removed_point - 1
-                    prev_removed_point = removed_point
-                    prev_unremoved_points.append(prev_unremoved_point)
-
-                next_removed_point = removed_points[-1]
-                next_unremoved_point = next_removed_point + 1
-                next_unremoved_points = [next_unremoved_point]
-                for removed_point in reversed(removed_points[:-1]):
-                    if next_removed_point != removed_point + 1:
-                        next_unremoved_point = removed_point + 1
-                    next_removed_point = removed_point
-                    next_unremoved_points.append(next_unremoved_point)
-                next_unremoved_points = reversed(next_unremoved_points)
-                for prev_unremoved_point, removed_point, next_unremoved_point in zip(prev_unremoved_points,
-                                                                                     removed_points,
-                                                                                     next_unremoved_points):
-                    stream = all_X[batch_index, :, channel_index]
-                    prev_stream = stream[prev_unremoved_point]
-                    next_stream = stream[next_unremoved_point]
-                    prev_time = times[prev_unremoved_point]
-                    next_time = times[next_unremoved_point]
-                    time = times[removed_point]
-                    ratio = (time - prev_time) / (next_time - prev_time)
-                    stream[removed_point] = prev_stream + ratio * (next_stream - prev_stream)
+        length = all_X.size(1)
+        num_removed = int(length * missing_rate)
+        # Sample every (batch, channel)'s removed points in one go: the indices of the num_removed smallest of
+        # length - 2 uniform draws are a uniformly random subset, exactly as per-(batch, channel) randperms would
+        # give, without length - 2 separate RNG calls per series. The + 1 keeps the start and end.
+        rand = torch.rand(all_X.size(0), length - 2, all_X.size(2), generator=generator)
+        removed_points = rand.topk(num_removed, dim=1, largest=False).indices + 1
+        removed_mask = torch.zeros(all_X.size(0), length, all_X.size(2), dtype=torch.bool)
+        removed_mask.scatter_(1, removed_points, True)
+
+        # For every point, find the index of the closest unremoved point before it and after it. (A point that hasn't
+        # been removed is its own closest unremoved point.) Forward/backward cumulative maximums/minimums over the
+        # masked indices do this without any Python-level loops; the start and end are never removed so the -1 and
+        # `length` sentinels never survive.
+        index = np.arange(length)[None, :, None]
+        removed_mask_np = removed_mask.numpy()
+        prev_index = np.maximum.accumulate(np.where(removed_mask_np, -1, index), axis=1)
+        next_index = np.minimum.accumulate(np.where(removed_mask_np, length, index)[:, ::-1], axis=1)[:, ::-1]
+        prev_index = torch.from_numpy(prev_index)
+        next_index = torch.from_numpy(np.ascontiguousarray(next_index))
+
+        prev_times = times[prev_index]
+        next_times = times[next_index]
+        # The clamp avoids a division by zero at the unremoved points (which are discarded by the `where` below).
+        ratio = (times.unsqueeze(0).unsqueeze(-1) - prev_times) / (next_times - prev_times).clamp(min=1e-7)
+        interpolated = torch.lerp(all_X.gather(1, prev_index), all_X.gather(1, next_index), ratio)
+        all_X = torch.where(removed_mask, interpolated, all_X)
 
     # Now fix the labels to be integers from 0 upwards
-    targets = co.OrderedDict()
-    counter = 0
-    for yi in all_y:
-        if yi not in targets:
-            targets[yi] = counter
-            counter += 1
-    all_y = torch.tensor([targets[yi] for yi in all_y])
+    _, inverse = np.unique(all_y, return_inverse=True)
+    all_y = torch.from_numpy(inverse.astype(np.int64))
+
+    lengths = torch.from_numpy(lengths)
+
+    return times, all_X, all_y, lengths, amount_train
+
+
+def get_data(dataset_name, missing_rate, noise_channels, max_shapelet_length_proportion=1.0):
+    assert dataset_name in valid_dataset_names, "Must specify a valid dataset name."
+
+    # Loading the .ts files and (especially) handling missingness are expensive, and hyperparameter searches call this
+    # many times with the same arguments, so the preprocessed tensors are cached on disk.
+    cache_dir = here / 'cache'
+    cache_filename = cache_dir / '{}_{}_{}.pt'.format(dataset_name, missing_rate, noise_channels)
+    if os.path.exists(cache_filename):
+        times, all_X, all_y, all_lengths, amount_train = torch.load(cache_filename)
+    else:
+        times, all_X, all_y, all_lengths, amount_train = _load_and_preprocess_data(dataset_name, missing_rate,
+                                                                                   noise_channels)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Stored at bfloat16 to halve the cache's disk and load footprint. (bfloat16 rather than float16 as it keeps
+        # float32's range, and the raw UEA values are unnormalised at this point.) The in-memory copy goes through the
+        # same round-trip so that runs behave identically whether or not they hit the cache.
+        all_X = all_X.to(torch.bfloat16)
+        # Several worker processes may miss the cache simultaneously, so save to a process-unique temporary file and
+        # atomically move it into place: concurrent readers only ever see complete files.
+        tmp_filename = '{}.tmp.{}'.format(cache_filename, os.getpid())
+        torch.save((times, all_X, all_y, all_lengths, amount_train), tmp_filename)
+        os.replace(tmp_filename, cache_filename)
+    # All computation downstream still happens at float32.
+    all_X = all_X.float()
+
+    num_classes = int(all_y.max()) + 1
+
+    # Batches of similar-length series are trimmed down to the longest series they contain, but never below the
+    # maximum shapelet length (else there would be nothing to compare the longest shapelets against).
+    maxlen = all_X.size(1)
+    min_length = min(maxlen, int(np.ceil((maxlen - 1) * max_shapelet_length_proportion)) + 1)
 
     # use original train/test splits
     trainval_X, test_X = all_X[:amount_train], all_X[amount_train:]
     trainval_y, test_y = all_y[:amount_train], all_y[amount_train:]
-
-    train_X, val_X, train_y, val_y = sklearn.model_selection.train_test_split(trainval_X, trainval_y,
-                                                                              train_size=0.8,
-                                                                              random_state=0,
-                                                                              shuffle=True,
-                                                                              stratify=trainval_y)
+    trainval_lengths, test_lengths = all_lengths[:amount_train], all_lengths[amount_train:]
+
+    # Split indices rather than the tensors themselves, so sklearn never round-trips the data through numpy; the
+    # tensors are then sliced directly. Same random_state and stratification, so the split itself is unchanged.
+    train_indices, val_indices = sklearn.model_selection.train_test_split(np.arange(trainval_y.size(0)),
+                                                                          train_size=0.8,
+                                                                          random_state=0,
+                                                                          shuffle=True,
+                                                                          stratify=trainval_y.numpy())
+    train_X, val_X = trainval_X[train_indices], trainval_X[val_indices]
+    train_y, val_y = trainval_y[train_indices], trainval_y[val_indices]
+    train_lengths, val_lengths = trainval_lengths[train_indices], trainval_lengths[val_indices]
 
     val_X = common.normalise_data(val_X, train_X)
     test_X = common.normalise_data(test_X, train_X)
     train_X = common.normalise_data(train_X, train_X)
 
-    train_dataset = torch.utils.data.TensorDataset(train_X, train_y)
-    val_dataset = torch.utils.data.TensorDataset(val_X, val_y)
-    test_dataset = torch.utils.data.TensorDataset(test_X, test_y)
+    train_dataset = torch.utils.data.TensorDataset(train_X, train_y, train_lengths)
+    val_dataset = torch.utils.data.TensorDataset(val_X, val_y, val_lengths)
+    test_dataset = torch.utils.data.TensorDataset(test_X, test_y, test_lengths)
 
-    train_dataloader = common.dataloader(train_dataset, batch_size=1024)
-    val_dataloader = common.dataloader(val_dataset, batch_size=1024)
-    test_dataloader = common.dataloader(test_dataset, batch_size=1024)
+    train_dataloader = common.dataloader(train_dataset, lengths=train_lengths, min_length=min_length,
+                                         batch_size=1024)
+    val_dataloader = common.dataloader(val_dataset, lengths=val_lengths, min_length=min_length,
+                                       batch_size=1024)
+    test_dataloader = common.dataloader(test_dataset, lengths=test_lengths, min_length=min_length,
+                                        batch_size=1024)
 
-    num_classes = counter
     input_channels = train_X.size(-1)
 
     assert num_classes >= 2, "Have only {} classes.".format(num_classes)
@@ -239,9 +269,8 @@ def main(dataset_name,                        # dataset parameters
          save_top_logreg_shapelets=False,     # True will save shapelets of the top logreg coefficients
          save_on_uniform_grid=False):         # Active if save_top_logreg_shapelets, will first sample onto a uniform grid
 
-    times, train_dataloader, val_dataloader, test_dataloader, num_classes, input_channels = get_data(dataset_name,
-                                                                                                     missing_rate,
-                                                                                                     noise_channels)
+    times, train_dataloader, val_dataloader, test_dataloader, num_classes, input_channels = \
+        get_data(dataset_name, missing_rate, noise_channels, max_shapelet_length_proportion)
 
     return common.main(times,
                        train_dataloader,
@@ -266,37 +295,54 @@ def main(dataset_name,                        # dataset parameters
                        save_on_uniform_grid)
 
 
+def _sweep_main(dataset_name, **kwargs):
+    # Target for the ProcessPoolExecutor sweeps below. The results object holds dataloaders and the model, whose
+    # collate_fn/discrepancy_fn closures cannot be pickled back to the parent - and the worker has already saved
+    # everything to disk via save_results - so discard it rather than returning it across the process boundary.
+    main(dataset_name, **kwargs)
+
+
 def hyperparameter_search_old():
     result_folder = 'uea_hyperparameter_search'
-    for dataset_name in datasets_by_cost:
-        for num_shapelets_per_class in (2, 3, 5):
-            for max_shapelet_length_proportion in (0.15, 0.3, 0.5, 1.0):
-                result_subfolder = 'old-' + str(num_shapelets_per_class) + '-' + str(max_shapelet_length_proportion)
-                if common.assert_not_done(result_folder, dataset_name + '-' + result_subfolder, n_done=1, seed=0):
-                    print("Starting comparison: " + dataset_name + '-' + result_subfolder)
-                    main(dataset_name,
-                         result_folder=result_folder,
-                         result_subfolder=result_subfolder,
-                         num_shapelets_per_class=num_shapelets_per_class,
-                         max_shapelet_length_proportion=max_shapelet_length_proportion,
-                         old_shapelets=True)
+    # Every configuration writes to its own result subfolder and is otherwise independent, so farm them out across
+    # processes and just wait for them all.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, os.cpu_count() // 2)) as executor:
+        futures = []
+        for dataset_name in datasets_by_cost:
+            for num_shapelets_per_class in (2, 3, 5):
+                for max_shapelet_length_proportion in (0.15, 0.3, 0.5, 1.0):
+                    result_subfolder = 'old-' + str(num_shapelets_per_class) + '-' + str(max_shapelet_length_proportion)
+                    if common.assert_not_done(result_folder, dataset_name + '-' + result_subfolder, n_done=1, seed=0):
+                        print("Starting comparison: " + dataset_name + '-' + result_subfolder)
+                        futures.append(executor.submit(_sweep_main, dataset_name,
+                                                       result_folder=result_folder,
+                                                       result_subfolder=result_subfolder,
+                                                       num_shapelets_per_class=num_shapelets_per_class,
+                                                       max_shapelet_length_proportion=max_shapelet_length_proportion,
+                                                       old_shapelets=True))
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
 
 
 def hyperparameter_search_l2():
     result_folder = 'uea_hyperparameter_search_l2'
-    for dataset_name in datasets_by_cost:
-        for num_shapelets_per_class in (2, 3, 5):
-            for max_shapelet_length_proportion in (0.15, 0.3, 0.5, 1.0):
-                result_subfolder = 'old-' + str(num_shapelets_per_class) + '-' + str(max_shapelet_length_proportion)
-                if common.assert_not_done(result_folder, dataset_name + '-' + result_subfolder, n_done=1, seed=0):
-                    print("Starting comparison: " + dataset_name + '-' + result_subfolder)
-                    main(dataset_name,
-                         result_folder=result_folder,
-                         result_subfolder=result_subfolder,
-                         num_shapelets_per_class=num_shapelets_per_class,
-                         max_shapelet_length_proportion=max_shapelet_length_proportion,
-                         discrepancy_fn='L2',
-                         old_shapelets=False)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, os.cpu_count() // 2)) as executor:
+        futures = []
+        for dataset_name in datasets_by_cost:
+            for num_shapelets_per_class in (2, 3, 5):
+                for max_shapelet_length_proportion in (0.15, 0.3, 0.5, 1.0):
+                    result_subfolder = 'old-' + str(num_shapelets_per_class) + '-' + str(max_shapelet_length_proportion)
+                    if common.assert_not_done(result_folder, dataset_name + '-' + result_subfolder, n_done=1, seed=0):
+                        print("Starting comparison: " + dataset_name + '-' + result_subfolder)
+                        futures.append(executor.submit(_sweep_main, dataset_name,
+                                                       result_folder=result_folder,
+                                                       result_subfolder=result_subfolder,
+                                                       num_shapelets_per_class=num_shapelets_per_class,
+                                                       max_shapelet_length_proportion=max_shapelet_length_proportion,
+                                                       discrepancy_fn='L2',
+                                                       old_shapelets=False))
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
 
 
 def comparison_test():
@@ -24,7 +24,9 @@ class CppDiscrepancy(torch.nn.Module):
     def forward(self, time, path1, path2):
         # We never actually call this forward method as part of the shapelet transform, but it's here in case people
         # want to try calling this outside of the shapelet transform.
-        return self.fn(time, path1, path2, self.arg)
+        # Contiguous inputs let the C++ kernel use stride-1 (vectorisable) loads rather than strided gathers; these
+        # calls are no-ops if the paths are already contiguous.
+        return self.fn(time, path1.contiguous(), path2.contiguous(), self.arg)
 
 
 class L2Discrepancy(CppDiscrepancy):
@@ -179,37 +181,51 @@ class LogsignatureDiscrepancy(torch.nn.Module):
         path2_batch_dims = path2.shape[:-2]
 
         if self.include_time:
-            # append time to both paths
-            time_channel1 = time_channel2 = times.unsqueeze(-1)
-            for dim in path1_batch_dims:
-                time_channel1 = time_channel1.unsqueeze(0).expand(dim, *time_channel1.shape)
-            for dim in path2_batch_dims:
-                time_channel2 = time_channel2.unsqueeze(0).expand(dim, *time_channel2.shape)
-            path1 = torch.cat([time_channel1, path1], dim=-1)
-            path2 = torch.cat([time_channel2, path2], dim=-1)
-
-        # Create a single batch dimension for compatibility with Signatory
-        path1 = path1.view(-1, path1.size(-2), path1.size(-1))
-        path2 = path2.view(-1, path2.size(-2), path2.size(-1))
+            # append time to both paths, writing straight into one preallocated tensor per path rather than
+            # materialising broadcast copies of times and concatenating
+            path1_with_time = path1.new_empty(*path1.shape[:-1], path1.size(-1) + 1)
+            path1_with_time[..., 0] = times
+            path1_with_time[..., 1:] = path1
+            path1 = path1_with_time
+            path2_with_time = path2.new_empty(*path2.shape[:-1], path2.size(-1) + 1)
+            path2_with_time[..., 0] = times
+            path2_with_time[..., 1:] = path2
+            path2 = path2_with_time
+
+        # Create a single batch dimension for compatibility with Signatory. Importantly this is done before any
+        # cross-broadcasting between the two sides, so that each distinct path has its logsignature computed exactly
+        # once; only the (much smaller) logsignatures are broadcast against each other below.
+        path1 = path1.reshape(-1, path1.size(-2), path1.size(-1))
+        path2 = path2.reshape(-1, path2.size(-2), path2.size(-1))
 
         logsignature1 = self.logsignature(path1)
         logsignature2 = self.logsignature(path2)
 
+        if self.pseudometric:
+            # The learnt map is linear, so applying it to each side separately here - before the cartesian broadcast
+            # between the two sides - gives the same discrepancy as applying it to the differences, whilst only
+            # needing to transform batch1 + batch2 logsignatures rather than batch1 * batch2 of them.
+            if self.metric_type == 'general':
+                logsignature1 = logsignature1 @ self.linear
+                logsignature2 = logsignature2 @ self.linear
+            else:
+                logsignature1 = logsignature1 * self.linear
+                logsignature2 = logsignature2 * self.linear
+
+        if self.p == 2:
+            # In the Euclidean case the pairwise norms over the cartesian product of the two sides are exactly a
+            # distance matrix, which cdist computes in a single fused call, without ever materialising the
+            # (batch1, batch2, channels) difference tensor that the general-p path below needs.
+            return torch.cdist(logsignature1, logsignature2).view(path1_batch_dims + path2_batch_dims)
+
         logsignature1 = logsignature1.view(*path1_batch_dims, logsignature1.size(-1))
         logsignature2 = logsignature2.view(*path2_batch_dims, logsignature2.size(-1))
 
         for _ in path1_batch_dims:
-            logsignature2.unsqueeze_(0)
+            logsignature2 = logsignature2.unsqueeze(0)
         for _ in path2_batch_dims:
-            logsignature1.unsqueeze_(-2)
-        logsignature1 = logsignature1.expand(*path1_batch_dims, *path2_batch_dims, logsignature1.size(-1))
-        logsignature2 = logsignature2.expand(*path1_batch_dims, *path2_batch_dims, logsignature1.size(-1))
+            logsignature1 = logsignature1.unsqueeze(-2)
 
         logsignature_diff = logsignature1 - logsignature2
 
-        if self.pseudometric:
-            if self.metric_type == 'general':
-                logsignature_diff = logsignature_diff @ self.linear
-            else:
-                logsignature_diff = logsignature_diff * self.linear
         return logsignature_diff.norm(p=self.p, dim=-1)